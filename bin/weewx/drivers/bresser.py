@@ -6,15 +6,100 @@ https://www.bresser.de/en/Weather-Time/BRESSER-PC-Weather-station-with-6-in-1-ou
 """
 import weeutil.weeutil
 import weewx.drivers
+import sys
 import time
+import threading
+import Queue
 import usb
 import syslog
 from datetime import datetime
 import pprint
 
+# pyudev is optional.  With it, a station that went away is picked up
+# again on the hotplug event instead of on the next polling interval.
+try:
+  import pyudev
+except ImportError:
+  pyudev = None
+
 DRIVER_NAME = 'BresserUSB'
 DRIVER_VERSION = "0.1"
 
+# Captured control frames:
+#fc07000000e550fd => First request, no response
+#fc030000002fa1fd => Second request, same response as d5
+#fc0813051de417fd => Set Date to 19 05 29
+#fc09011e1cfb83fd => Set time to 2019-05-29 01:30:28
+#fc09021e0ff9f8fd => Set time to 2019-05-29 02:30:15
+#fc090c00078c42fd => Set time to 2019-05-29 12:00:07
+#fcd4010000e1bffd => 'normal' data request
+#fcd4020000b8effd => in case of f1 response
+#fcd5010000970bfd => 'normal' data request
+#fcd5020000ce5bfd => in case of f1 response
+_REQUEST_BYTES = {
+  "d4": [0xfc, 0xd4, 0x01, 0x00, 0x00, 0xe1, 0xbf, 0xfd],
+  "d42":[0xfc, 0xd4, 0x02, 0x00, 0x00, 0xb8, 0xef, 0xfd],
+  "d5": [0xfc, 0xd5, 0x01, 0x00, 0x00, 0x97, 0x0b, 0xfd],
+  "d52":[0xfc, 0xd5, 0x02, 0x00, 0x00, 0xce, 0x5b, 0xfd]
+}
+
+# setTime frame templates; bytes 2-4 carry year/month/day resp.
+# hour/minute/second and are filled in before sending.  Bytes 5-6 are
+# the checksum slots: the console accepts them as constant zeros, so
+# they are baked into the template and never recomputed.
+_SET_DATE_MSG = [0xfc, 0x08, 0x00, 0x00, 0x00, 0x00, 0x00, 0xfd]
+_SET_TIME_MSG = [0xfc, 0x09, 0x00, 0x00, 0x00, 0x00, 0x00, 0xfd]
+
+# Map loop packet observation names to their column in the dataset.
+# Built once at import so each packet needs only a single conversion pass.
+_FIELDS = (
+  ('inTemp',      3),  #Celsius
+  ('inHumidity',  4),  #%REL
+  ('outTemp',     5),  #Celsius
+  ('outHumidity', 6),  #%REL
+  ('rainDaily',   7),  #mm accumulated
+  ('rainPerHour', 8),  #mm/hr
+  ('windSpeed',   9),  #km/h
+  ('windGust',   10),  #km/h
+  ('windDir',    11),  #degrees
+  ('windOrdinal',12),  #N,NNE,NE,ENE,E,ESE,SE,SSE,S,SSW,SW,WSW,W,WNW,NW,NNW
+  ('barometer',  13),  #mBar/hPa
+  ('pressure',   14),  #mBar/hPa
+  ('UV',         15),  #"index"
+  ('dewPoint',   16),  #Celsius
+  ('heatIndex',  17),  #Celsius
+  ('extraTemp1', 18),  #Celsius
+  ('extraHumid1',19),  #%REL
+  ('extraTemp2', 20),  #Celsius
+  ('extraHumid2',21),  #%REL
+  ('extraTemp3', 22),  #Celsius
+  ('extraHumid3',23),  #%REL
+  ('extraTemp4', 24),  #Celsius
+  ('extraHumid4',25),  #%REL
+  ('extraTemp5', 26),  #Celsius
+  ('extraHumid5',27),  #%REL
+  ('extraTemp6', 28),  #Celsius
+  ('extraHumid6',29),  #%REL
+  ('extraTemp7', 30),  #Celsius
+  ('extraHumid7',31),  #%REL
+)
+
+# Every loop packet starts as a copy of this template; only the values
+# that change from dataset to dataset are written on top of it.
+_PACKET_TEMPLATE = {
+  'usUnits' : weewx.METRIC,
+  'dateTime': None,
+  'rain'    : 0.0,
+}
+
+# requestType bitmap shared by every control transfer the driver makes
+_USB_REQUEST_TYPE = usb.TYPE_CLASS + usb.RECIP_INTERFACE
+
+# Scheduling clock for the reconnect loop.  time.monotonic does not exist
+# on python 2, where time.time (and with it a sensitivity to wall clock
+# steps while waiting) is the best we can do.
+_sched_clock = getattr(time, 'monotonic', time.time)
+
 def loader(config_dict, engine):
   return BresserUSB(**config_dict[DRIVER_NAME])
 
@@ -54,16 +139,19 @@ class BresserUSBConfigurator(weewx.drivers.AbstractConfigurator):
     self.station.closePort()
 
   def show_live(self):
+    # pformat the whole packet and hand it to stdout in one write, so a
+    # packet is a single flush instead of a stream of pprint fragments
     pp = pprint.PrettyPrinter(indent=2)
+    write = sys.stdout.write
     for packet in self.station.genLoopPackets():
-      pp.pprint(packet)
+      write(pp.pformat(packet) + "\n")
+      sys.stdout.flush()
 
   def set_time(self):
     self.station.setTime()
 
 def logmsg(level, msg):
-  #syslog.syslog(level, 'fousb: %s' % msg)
-  print '%s: bresserusb: %s' % (level, msg)
+  syslog.syslog(level, 'bresser: %s' % msg)
 
 def logdbg(msg):
   logmsg(syslog.LOG_DEBUG, msg)
@@ -90,10 +178,21 @@ class BresserUSB(weewx.drivers.AbstractDevice):
     self.loop_interval = 15
     self.openport_interval = 15
     self.timeout       = float(stn_dict.get('timeout', 15))
+    self.timeout_ms    = int(self.timeout * 1000)
     self.debug         = int(stn_dict.get('debug', 0))
     self.last_time     = None
     self.last_rain     = None
     self.devh          = None
+    self._last_bus     = None
+    self._udev_monitor = None
+    self._dataset_queue = Queue.Queue()
+    self._read_thread  = None
+    # True while this instance owns the station; closePort clears it to
+    # shut the reader thread down
+    self._running      = True
+    self._set_time_req = False
+    self._set_date_msg = bytearray(_SET_DATE_MSG)
+    self._set_time_msg = bytearray(_SET_TIME_MSG)
     loginf('driver version is %s' % DRIVER_VERSION)
     self.openPort()
 
@@ -101,14 +200,14 @@ class BresserUSB(weewx.drivers.AbstractDevice):
     if self.devh is not None:
       return
 
-    current_time = time.time()
+    next_attempt = _sched_clock() + self.openport_interval
     dev = self._find_device()
     while not dev:
+      if not self._running:
+        raise weewx.WeeWxIOError("Port closed while waiting for the station")
       logerr("Cannot find USB device with Vendor=0x%04x ProdID=0x%04x" % (self.vendor_id, self.product_id))
-      sleep_time = current_time + self.openport_interval - time.time()
-      if sleep_time > 0:
-        time.sleep(sleep_time)
-      current_time += self.openport_interval
+      self._wait_for_device(next_attempt - _sched_clock())
+      next_attempt = _sched_clock() + self.openport_interval
       dev = self._find_device()
 
     self.devh = dev.open()
@@ -118,7 +217,7 @@ class BresserUSB(weewx.drivers.AbstractDevice):
     # be sure kernel does not claim the interface
     try:
       self.devh.detachKernelDriver(self.usb_interface)
-    except:
+    except usb.USBError:
       pass
 
     # attempt to claim the interface
@@ -129,18 +228,76 @@ class BresserUSB(weewx.drivers.AbstractDevice):
       logcrt("Unable to claim USB interface %s: %s" % (self.usb_interface, e))
       raise weewx.WeeWxIOError(e)
 
+    # Bind the transfer methods once per open: read_usb_block issues two
+    # transfers per packet and the repeated pyusb lookups are measurable.
+    self._control_msg = self.devh.controlMsg
+    self._interrupt_read = self.devh.interruptRead
+
   def closePort(self):
-    try:
-      self.devh.releaseInterface()
-    except:
-      pass
+    # drop the flag first so the reader thread gives up instead of
+    # racing us and re-claiming the device after teardown
+    self._running = False
+    self._release_interface()
+
+  def _release_interface(self):
+    """Give up the device handle without shutting the driver down."""
+    if self.devh is not None:
+      try:
+        self.devh.releaseInterface()
+      except usb.USBError:
+        pass
     self.devh = None
+    self._control_msg = None
+    self._interrupt_read = None
+
+  def _wait_for_device(self, max_wait):
+    """Wait up to max_wait seconds before the next device scan.
+
+    With pyudev available this blocks on the udev netlink monitor and
+    returns as soon as a USB device is added, so a replugged station is
+    picked up immediately; without it, sleep out the interval as
+    before.  Either way the wait runs in short slices so a closePort
+    from another thread is noticed promptly instead of after the full
+    interval."""
+    if max_wait <= 0:
+      return
+    deadline = _sched_clock() + max_wait
+    if pyudev is not None:
+      try:
+        if self._udev_monitor is None:
+          self._udev_monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+          self._udev_monitor.filter_by(subsystem='usb')
+          loginf('waiting for udev hotplug events to reconnect')
+        while self._running:
+          remaining = deadline - _sched_clock()
+          if remaining <= 0:
+            return
+          device = self._udev_monitor.poll(timeout=min(remaining, 1.0))
+          if device is not None and device.action == 'add':
+            return
+        return
+      except Exception as e:
+        logerr("udev monitor failed (%s); falling back to polling" % e)
+        self._udev_monitor = None
+    while self._running:
+      remaining = deadline - _sched_clock()
+      if remaining <= 0:
+        return
+      time.sleep(min(remaining, 1.0))
 
   def _find_device(self):
-    """Find the vendor and product ID on the USB."""
-    for bus in usb.busses():
+    """Find the vendor and product ID on the USB.
+
+    The bus the station was last seen on is tried first: after a
+    reconnect the console nearly always comes back on the same bus, so
+    we rarely have to walk every hub on the system."""
+    busses = usb.busses()
+    if self._last_bus is not None:
+      busses = sorted(busses, key=lambda b: b.location != self._last_bus)
+    for bus in busses:
       for dev in bus.devices:
         if dev.idVendor == self.vendor_id and dev.idProduct == self.product_id:
+          self._last_bus = bus.location
           loginf('found station with Vendor=0x%04x ProdID=0x%04x on USB bus=%03i device=%03i' % (self.vendor_id, self.product_id, bus.location, dev.devnum))
           return dev
     return None
@@ -153,97 +310,93 @@ class BresserUSB(weewx.drivers.AbstractDevice):
     now = datetime.now()
     date = now.date()
     time = now.time()
+    date_msg = self._set_date_msg
+    date_msg[2] = date.year-2000
+    date_msg[3] = date.month
+    date_msg[4] = date.day
+    time_msg = self._set_time_msg
+    time_msg[2] = time.hour
+    time_msg[3] = time.minute
+    time_msg[4] = time.second
+    # The console only understands separate date (0x08) and time (0x09)
+    # frames, so they cannot be merged into one request; with both
+    # buffers prepared above the second send follows the first with no
+    # python work in between.
+    control_msg = self._control_msg
+    if control_msg is None:
+      logerr("Cannot set station time to %s: USB port not open" % now.strftime("%Y-%m-%d %H:%M:%S"))
+      return
     try:
-      self.devh.controlMsg(usb.TYPE_CLASS + usb.RECIP_INTERFACE, 0x0000009,
-          [0xfc, 0x08, date.year-2000, date.month, date.day, 0x00, 0x00, 0xfd],
-           0x0000200, 0x0000000, 1000)
-      self.devh.controlMsg(usb.TYPE_CLASS + usb.RECIP_INTERFACE, 0x0000009,
-          [0xfc, 0x09, time.hour, time.minute, time.second, 0x00, 0x00, 0xfd],
-           0x0000200, 0x0000000, 1000)
-    except e:
-        logerr("Failed to set station time to %s: %s" % (now.strftime("%Y-%m-%d %H:%M:%S"), e))
+      control_msg(_USB_REQUEST_TYPE, 0x0000009,
+          date_msg, 0x0000200, 0x0000000, 1000)
+      control_msg(_USB_REQUEST_TYPE, 0x0000009,
+          time_msg, 0x0000200, 0x0000000, 1000)
+    except usb.USBError as e:
+      logerr("Failed to set station time to %s: %s" % (now.strftime("%Y-%m-%d %H:%M:%S"), e))
+      return
     loginf("Set station time to %s" % now.strftime("%Y-%m-%d %H:%M:%S"))
 
   def genLoopPackets(self):
+    if self._read_thread is None or not self._read_thread.is_alive():
+      self._read_thread = threading.Thread(target=self._read_loop)
+      self._read_thread.setDaemon(True)
+      self._read_thread.start()
     while True:
       try:
-        dataset=self.read_usb_dataset()
-      except usb.USBError:
-        logerr("Lost USB connection. Reconnecting...")
-        self.closePort()
-        self.openPort()
+        # a bounded get instead of a bare one: blocking forever on the
+        # queue's lock would keep python 2 from delivering SIGTERM/SIGHUP
+        # while the station is unplugged and nothing arrives
+        dataset = self._dataset_queue.get(True, self.timeout)
+      except Queue.Empty:
         continue
-      except:
-        break 
+      if isinstance(dataset, Exception):
+        # surface the reader thread's failure to the engine, whose
+        # WeeWxIOError handler will wait and call us again; the dead
+        # thread is restarted on re-entry above
+        logerr("Reader thread failed: %s" % dataset)
+        raise weewx.WeeWxIOError(dataset)
 
       ds=dataset.split()
       #2 2019-06-18 23:33 25.4 58 19.5 69 0.0 0.0 3.6 3.6 253 WSW 1014 953 0 13.6 --.- --.- -- --.- -- --.- -- --.- -- --.- -- --.- -- --.- --
       if len(ds) != 32:
-        logerr("Got dataset with %i entries (instead of 32): '%s'" % (len(ds), dataset))
+        # repr keeps stray high bytes ascii-safe for syslog
+        logerr("Got dataset with %i entries (instead of 32): %s" % (len(ds), repr(dataset)))
         continue
         
-      ds_index = ds[0]
       ds_date  = ds[1]
       ds_time  = ds[2]
-      computer_now = datetime.now()
-      station_now = computer_now
+      this_time = time.time()
       try:
-        station_now = datetime.strptime(ds_date + " " + ds_time, "%Y-%m-%d %H:%M")
-      except ValueError as e:
-        logerr("Got dataset with invalid time: %s" % e)
+        # The station always sends "YYYY-MM-DD HH:MM", so pull the integers
+        # out directly instead of paying for strptime on every loop packet.
+        year, month, day = ds_date.split("-")
+        hour, minute = ds_time.split(":")
+        station_time = time.mktime((int(year), int(month), int(day),
+                                    int(hour), int(minute), 0, 0, 0, -1))
+      except (ValueError, OverflowError) as e:
+        logerr("Got dataset with invalid time %s %s: %s" % (repr(ds_date), repr(ds_time), e))
         continue
-      deltat = (computer_now-station_now)
-      if deltat.total_seconds() > 70 or deltat.total_seconds() < -10:
-        loginf("Delta too big: %i (Computer: %s, Station: %s)" % (deltat.total_seconds(), computer_now, station_now))
-        self.setTime()
-      this_time = time.time()
+      deltat = this_time - station_time
+      if deltat > 70 or deltat < -10:
+        loginf("Delta too big: %i (Computer: %s, Station: %s)" %
+               (deltat, weeutil.weeutil.timestamp_to_string(this_time),
+                weeutil.weeutil.timestamp_to_string(station_time)))
+        # the reader thread owns the USB handle; ask it to set the clock
+        # between datasets instead of interleaving transfers from here
+        self._set_time_req = True
       if self.last_time == None:
         self.last_time = this_time
-      packet = {
-        'usUnits': weewx.METRIC,
-        'dateTime': int((this_time+self.last_time)/2.0)
-      }
+      packet = dict(_PACKET_TEMPLATE)
+      packet['dateTime'] = int((this_time+self.last_time)/2.0)
 
       #2 2019-06-18 23:33 25.4 58 19.5 69 0.0 0.0 3.6 3.6 253 WSW 1014 953 0 13.6 --.- --.- -- --.- -- --.- -- --.- -- --.- -- --.- -- --.- --
-      weatherdata = {
-        'inTemp'      : ds[3], #Celsius
-        'inHumidity'  : ds[4], #%REL
-        'outTemp'     : ds[5], #Celsius
-        'outHumidity' : ds[6], #%REL
-        'rainDaily'   : ds[7], #mm accumulated
-        'rainPerHour' : ds[8], #mm/hr
-        'windSpeed'   : ds[9], #km/h
-        'windGust'    : ds[10], #km/h
-        'windDir'     : ds[11], #degrees
-        'windOrdinal' : ds[12], #N,NNE,NE,ENE,E,ESE,SE,SSE,S,SSW,SW,WSW,W,WNW,NW,NNW
-        'barometer'   : ds[13], #mBar/hPa
-        'pressure'    : ds[14], #mBar/hPa
-        'UV'          : ds[15], #"index"
-        'dewPoint'    : ds[16], #Celsius
-        'heatIndex'   : ds[17], #Celsius
-        'extraTemp1'  : ds[18], #Celsius
-        'extraHumid1' : ds[19], #mBar/hPa
-        'extraTemp2'  : ds[20], #Celsius
-        'extraHumid2' : ds[21], #mBar/hPa
-        'extraTemp3'  : ds[22], #Celsius
-        'extraHumid3' : ds[23], #mBar/hPa
-        'extraTemp4'  : ds[24], #Celsius
-        'extraHumid4' : ds[25], #mBar/hPa
-        'extraTemp5'  : ds[26], #Celsius
-        'extraHumid5' : ds[27], #mBar/hPa
-        'extraTemp6'  : ds[28], #Celsius
-        'extraHumid6' : ds[29], #mBar/hPa
-        'extraTemp7'  : ds[30], #Celsius
-        'extraHumid7' : ds[31], #mBar/hPa
-      }
-
-      for key in weatherdata:
+      for key, i in _FIELDS:
         try:
-          packet[key] = float(weatherdata[key])
-        except:
+          packet[key] = float(ds[i])
+        except ValueError:
+          # missing sensors report '--.-', non-numeric ordinals are skipped
           pass
 
-      packet['rain'] = 0.0
       if 'rainDaily' in packet: #station sends rain in mm/day, weewx expects cm per interval
         if self.last_rain != None:
           packet['rain'] = 0.1*(packet['rainDaily']-self.last_rain)
@@ -251,54 +404,81 @@ class BresserUSB(weewx.drivers.AbstractDevice):
       yield packet
       self.last_time = this_time
 
+  def _read_loop(self):
+    """Drain the station from a dedicated thread.
+
+    The interrupt reads block in C with the GIL released, so polling from
+    its own thread lets packet parsing and the rest of the engine run
+    while we wait on the hardware.  Datasets are handed to the main
+    thread through a queue; a fatal error is queued as the exception
+    itself so the generator can wind down.
+
+    This thread owns the device handle while it runs: setTime requests
+    from the drift check are taken care of here, between dataset reads,
+    so control transfers never interleave with a d5 block sequence."""
+    while self._running:
+      if self._set_time_req:
+        self._set_time_req = False
+        self.setTime()
+      try:
+        dataset = self.read_usb_dataset()
+      except usb.USBError:
+        if not self._running:
+          # closePort pulled the handle out from under the read; this is
+          # a shutdown, not a device loss
+          break
+        logerr("Lost USB connection. Reconnecting...")
+        self._release_interface()
+        try:
+          self.openPort()
+        except weewx.WeeWxIOError as e:
+          # hand the failure to the consumer so the engine's own retry
+          # logic fires instead of the thread dying silently
+          self._dataset_queue.put(e)
+          break
+        continue
+      except Exception as e:
+        self._dataset_queue.put(e)
+        break
+      self._dataset_queue.put(dataset)
+
   def read_usb_dataset(self):
-    dataset = ""
-    response = self.read_usb_block("d5")
-    packettype = response[0]
-    packetcount= response[5]
-    packetlen  = response[6]
-    #print "0x%02X / 0x%02X (%i)\n" % (packettype, packetcount, packetlen)
-    
-    while packetcount != 0x31:
-      response = self.read_usb_block("d5")
-      packettype = response[0]
-      packetcount= response[5]
-      packetlen  = response[6]
-      #print "0x%02X / 0x%02X (%i)\n" % (packettype, packetcount, packetlen)
-    
-    while packetcount in [0x31, 0x32, 0x33]:
-      dataset += "".join(map(chr, response[7:7+packetlen]))
-      response = self.read_usb_block("d5")
-      packettype = response[0]
-      packetcount= response[5]
-      packetlen  = response[6]
-      #print "0x%02X / 0x%02X (%i)\n" % (packettype, packetcount, packetlen)
-    return dataset
-
-  def read_usb_block(self, requesttype):
-    #fc07000000e550fd => First request, no response
-    #fc030000002fa1fd => Second request, same response as d5
-    #fc0813051de417fd => Set Date to 19 05 29
-    #fc09011e1cfb83fd => Set time to 2019-05-29 01:30:28
-    #fc09021e0ff9f8fd => Set time to 2019-05-29 02:30:15
-    #fc090c00078c42fd => Set time to 2019-05-29 12:00:07
-    #fcd4010000e1bffd => 'normal' data request
-    #fcd4020000b8effd => in case of f1 response
-    #fcd5010000970bfd => 'normal' data request
-    #fcd5020000ce5bfd => in case of f1 response
-    requestbytes = {
-      "d4": [0xfc, 0xd4, 0x01, 0x00, 0x00, 0xe1, 0xbf, 0xfd],
-      "d42":[0xfc, 0xd4, 0x02, 0x00, 0x00, 0xb8, 0xef, 0xfd],
-      "d5": [0xfc, 0xd5, 0x01, 0x00, 0x00, 0x97, 0x0b, 0xfd],
-      "d52":[0xfc, 0xd5, 0x02, 0x00, 0x00, 0xce, 0x5b, 0xfd]
-    }
-    self.devh.controlMsg(usb.TYPE_CLASS + usb.RECIP_INTERFACE,
-                         0x0000009,
-                         requestbytes[requesttype],
-                         0x0000200,
-                         0x0000000,
-                         1000)
-    data = self.devh.interruptRead(self.usb_endpoint,
-                                   self.usb_read_size, # bytes to read
-                                   int(self.timeout*1000))
-    return list(data)
+    """Assemble one dataset from the station's packet sequence.
+
+    Blocks are requested until the 0x31 packet that starts a dataset
+    shows up, then payloads are accumulated until the first packet past
+    the 0x31/0x32/0x33 run."""
+    dataset = bytearray()
+    synced = False
+    # resolve the d5 request frame once and resubmit the same buffer for
+    # every block of the probe-then-stream sequence
+    request = _REQUEST_BYTES["d5"]
+    read_block = self.read_usb_block
+    while True:
+      response = read_block(request)
+      packetcount = response[5]
+      if not synced:
+        if packetcount != 0x31:
+          continue
+        synced = True
+      elif packetcount not in (0x31, 0x32, 0x33):
+        break
+      dataset.extend(response[7:7+response[6]])
+    # latin-1 maps each byte straight to its code point, same as the old
+    # per-byte chr() join, but in a single C-level pass.
+    return dataset.decode('latin-1')
+
+  def read_usb_block(self, request):
+    """Submit a request frame from _REQUEST_BYTES and read the response."""
+    self._control_msg(_USB_REQUEST_TYPE,
+                      0x0000009,
+                      request,
+                      0x0000200,
+                      0x0000000,
+                      1000)
+    data = self._interrupt_read(self.usb_endpoint,
+                                self.usb_read_size, # bytes to read
+                                self.timeout_ms)
+    # a compact byte buffer instead of a list of boxed ints; slicing and
+    # extending in read_usb_dataset then stay at the C level
+    return bytearray(data)